@@ -11,7 +11,106 @@ from qgis.core import (
     QgsProcessing,
     QgsRasterLayer
 )
-import ee, os, urllib.request, zipfile
+import asyncio, ee, os, requests, shutil, threading, zipfile
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+try:
+    from isal import isal_zlib
+except ImportError:
+    isal_zlib = None
+
+# zipfile has no hook for a decompressor, so the override is swapped in per entry under a lock
+_zip_patch_lock = threading.Lock()
+
+
+def _isal_get_decompressor(compress_type, _default=zipfile._get_decompressor):
+    if compress_type == zipfile.ZIP_DEFLATED:
+        return isal_zlib.decompressobj(-15)
+    return _default(compress_type)
+
+
+def _open_entry(zin, name):
+    """Open a ZIP entry, inflating DEFLATE data with ISA-L's SIMD implementation when it is installed."""
+    if isal_zlib is None:
+        return zin.open(name)
+    # ZipExtFile takes its decompressor in __init__, so the patch only has to span open();
+    # reading the entry afterwards runs unpatched and other zipfile users never see the override
+    with _zip_patch_lock:
+        original = zipfile._get_decompressor
+        zipfile._get_decompressor = _isal_get_decompressor
+        try:
+            return zin.open(name)
+        finally:
+            zipfile._get_decompressor = original
+
+
+CHUNK_SIZE = 1 << 20
+DOWNLOAD_PARTS = 8
+YEAR_WORKERS = 8
+
+
+def _write_stream(resp, path):
+    """Write a streamed response body to disk in fixed-size chunks."""
+    with open(path, 'wb') as f:
+        for chunk in resp.iter_content(chunk_size=CHUNK_SIZE):
+            f.write(chunk)
+
+
+async def _ranged_download(url, path, size, parts):
+    """Fetch the first size bytes of url as concurrent byte ranges written at their offsets."""
+    # No overall deadline for large archives, but a stalled socket fails like the requests path does
+    timeout = aiohttp.ClientTimeout(total=None, sock_read=60)
+    connector = aiohttp.TCPConnector(limit=parts)
+    # Raw bytes only: a compressed 206 body would otherwise be inflated and written at the wrong offsets
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout, auto_decompress=False) as session:
+        with open(path, 'wb') as f:
+            f.truncate(size)
+
+            async def fetch(start, end):
+                headers = {'Range': f'bytes={start}-{end}', 'Accept-Encoding': 'identity'}
+                async with session.get(url, headers=headers) as resp:
+                    resp.raise_for_status()
+                    if resp.status != 206:
+                        raise aiohttp.ClientPayloadError('Server ignored the Range header')
+                    offset = start
+                    async for chunk in resp.content.iter_chunked(CHUNK_SIZE):
+                        # No await between seek and write, so concurrent ranges cannot interleave
+                        f.seek(offset)
+                        f.write(chunk)
+                        offset += len(chunk)
+
+            step = -(-size // parts)
+            await asyncio.gather(*(fetch(a, min(a + step, size) - 1) for a in range(0, size, step)))
+
+
+def _download(url, path, session, parts=DOWNLOAD_PARTS):
+    """Download url to path over the pooled session, switching to parallel ranges only when the response offers them."""
+    with session.get(url, stream=True, timeout=60) as resp:
+        resp.raise_for_status()
+        size = int(resp.headers.get('Content-Length', 0))
+        ranged = (aiohttp is not None and size > 0
+                  and resp.headers.get('Accept-Ranges') == 'bytes'
+                  and 'Content-Encoding' not in resp.headers)
+        if not ranged:
+            # The common case for dynamic EE downloads: one GET on an already open connection
+            _write_stream(resp, path)
+            return
+
+    try:
+        asyncio.run(_ranged_download(url, path, size, parts))
+        return
+    except (aiohttp.ClientError, asyncio.TimeoutError):
+        pass
+    with session.get(url, stream=True, timeout=60) as resp:
+        resp.raise_for_status()
+        _write_stream(resp, path)
+
 
 class DownloadVIIRSAnnual(QgsProcessingAlgorithm):
     INPUT_LAYER   = 'INPUT_LAYER'
@@ -88,51 +187,68 @@ class DownloadVIIRSAnnual(QgsProcessingAlgorithm):
             ee.Authenticate()
             ee.Initialize()
 
-        for y in years_sel:
-            start = f"{y}-01-01"
-            end = f"{y}-12-31"
-            feedback.pushInfo(f"Memproses komposit {y}")
-            coll = (
-                ee.ImageCollection('NOAA/VIIRS/DNB/MONTHLY_V1/VCMSLCFG')
-                    .select('avg_rad')
-                    .filterDate(start, end)
-                    .filterBounds(roi)
-            )
-            if coll.size().getInfo() == 0:
-                feedback.pushWarning(f"Data {y} tidak ditemukan.")
-                continue
-
-            img = coll.mean().clip(roi)
-            url = img.getDownloadURL({'scale': 500, 'region': roi.toGeoJSONString(), 'crs': 'EPSG:4326'})
-
-            # Download original ZIP
-            zip_path = os.path.join(out_folder, f"VIIRS_{y}.zip")
-            urllib.request.urlretrieve(url, zip_path)
-
-            # Extract the first TIFF
-            extracted_tif = None
-            with zipfile.ZipFile(zip_path, 'r') as zin:
-                for fn in zin.namelist():
-                    if fn.lower().endswith('.tif'):
-                        extracted_tif = zin.extract(fn, out_folder)
-                        break
-
-            if not extracted_tif or not zipfile.is_zipfile(zip_path):
-                feedback.pushWarning(f"Gagal mengekstrak TIFF untuk {y}.")
-                continue
-
-            # Rename the TIFF to standard name
-            new_name = f"VIIRS_{y}.tif"
-            new_path = os.path.join(out_folder, new_name)
-            os.replace(extracted_tif, new_path)
-
-            # Repackage into ZIP with renamed TIFF
-            with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED) as zout:
-                zout.write(new_path, arcname=new_name)
-
-            # Load into QGIS
-            layer = QgsRasterLayer(new_path, f"VIIRS_{y}")
-            if layer.isValid():
-                QgsProject.instance().addMapLayer(layer)
+        # The region is the same for every year; one pooled session keeps connections alive across downloads
+        region = roi.toGeoJSONString()
+        adapter = HTTPAdapter(pool_connections=YEAR_WORKERS, pool_maxsize=YEAR_WORKERS)
+        with requests.Session() as session:
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+
+            def process_year(y):
+                # Runs on a worker thread: no feedback or project calls here
+                start = f"{y}-01-01"
+                end = f"{y}-12-31"
+                coll = (
+                    ee.ImageCollection('NOAA/VIIRS/DNB/MONTHLY_V1/VCMSLCFG')
+                        .select('avg_rad')
+                        .filterDate(start, end)
+                        .filterBounds(roi)
+                )
+                # An empty collection usually makes getDownloadURL fail, so no separate size() round-trip is needed
+                img = coll.mean().clip(roi)
+                try:
+                    url = img.getDownloadURL({'scale': 500, 'region': region, 'crs': 'EPSG:4326'})
+                except ee.EEException as e:
+                    return y, None, f"Data {y} tidak ditemukan: {e}"
+
+                # Download original ZIP, then extract the first TIFF straight to its standard name;
+                # an empty composite may only fail here, so report it for this year instead of aborting the run
+                zip_path = os.path.join(out_folder, f"VIIRS_{y}.zip")
+                new_name = f"VIIRS_{y}.tif"
+                new_path = os.path.join(out_folder, new_name)
+                extracted = False
+                try:
+                    _download(url, zip_path, session)
+                    with zipfile.ZipFile(zip_path, 'r') as zin:
+                        for fn in zin.namelist():
+                            if fn.lower().endswith('.tif'):
+                                with _open_entry(zin, fn) as src, open(new_path, 'wb') as dst:
+                                    shutil.copyfileobj(src, dst, CHUNK_SIZE)
+                                extracted = True
+                                break
+                except (requests.RequestException, zipfile.BadZipFile) as e:
+                    return y, None, f"Gagal mengunduh data {y}: {e}"
+
+                if not extracted:
+                    return y, None, f"Gagal mengekstrak TIFF untuk {y}."
+
+                # Repackage into ZIP with renamed TIFF, stored without a second DEFLATE pass
+                with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_STORED) as zout:
+                    zout.write(new_path, arcname=new_name)
+                return y, new_path, None
+
+            # Years are independent and mostly wait on the network, so fetch them concurrently
+            for y in years_sel:
+                feedback.pushInfo(f"Memproses komposit {y}")
+            with ThreadPoolExecutor(max_workers=max(1, min(YEAR_WORKERS, len(years_sel)))) as executor:
+                for y, new_path, warning in executor.map(process_year, years_sel):
+                    if warning:
+                        feedback.pushWarning(warning)
+                        continue
+
+                    # Load into QGIS
+                    layer = QgsRasterLayer(new_path, f"VIIRS_{y}")
+                    if layer.isValid():
+                        QgsProject.instance().addMapLayer(layer)
 
         return {}
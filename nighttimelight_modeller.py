@@ -24,10 +24,135 @@ from qgis.core import (
 )
 import numpy as np
 import os
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+from functools import lru_cache
 import rasterio
-import matplotlib.pyplot as plt
-from sklearn.linear_model import LinearRegression, Ridge, Lasso
-from sklearn.preprocessing import PolynomialFeatures, MinMaxScaler, StandardScaler
+from matplotlib.figure import Figure
+from numba import njit, prange
+
+TILE_SIZE = 512
+SCATTER_SAMPLES = 10000
+
+
+def _normalize(Y, norm_name):
+    """Scale every pixel series (rows of Y) the way MinMaxScaler/StandardScaler would."""
+    if norm_name=='MinMax':
+        offset = Y.min(axis=1, keepdims=True)
+        scale = Y.max(axis=1, keepdims=True) - offset
+    elif norm_name=='Z-score':
+        offset = Y.mean(axis=1, keepdims=True)
+        scale = Y.std(axis=1, keepdims=True)
+    else:
+        return Y, 0.0, 1.0
+    scale[scale==0] = 1.0
+    return (Y - offset) / scale, offset, scale
+
+
+@lru_cache(maxsize=None)
+def _cupy():
+    """CuPy module when a CUDA device is present, else None; probed on first use so loading the plugin creates no CUDA context."""
+    try:
+        import cupy as cp
+        return cp if cp.cuda.runtime.getDeviceCount() > 0 else None
+    except Exception:
+        return None
+
+
+def _array_module(a):
+    """numpy for host arrays, CuPy for device arrays, so the dense helpers below run on either."""
+    return np if isinstance(a, np.ndarray) else _cupy()
+
+
+def _fit_linear(X, Y):
+    """Least-squares fit with intercept of every pixel series (rows of Y), as one GEMM with the pseudo-inverse of X."""
+    x_mean = X.mean(axis=0)
+    y_mean = Y.mean(axis=1)
+    # Centre Y too, so constant series get exactly zero slopes despite float32 rounding
+    Yc = Y - y_mean[:,None]
+    beta = Yc @ _array_module(X).linalg.pinv(X - x_mean).T
+    return beta, y_mean - beta @ x_mean
+
+
+def _fit_ridge(X, Y, alpha=1.0):
+    """Ridge fit with unpenalized intercept of every pixel series (rows of Y), solved once through the SVD of X."""
+    x_mean = X.mean(axis=0)
+    y_mean = Y.mean(axis=1)
+    U, S, Vt = _array_module(X).linalg.svd(X - x_mean, full_matrices=False)
+    d = S / (S*S + alpha)
+    beta = (Y - y_mean[:,None]) @ (U * d) @ Vt
+    return beta, y_mean - beta @ x_mean
+
+
+@njit(parallel=True, cache=True)
+def _valid_mask(stack, nodata, out):
+    """Flag pixels holding no NoData value in any band, without a (T, H, W) boolean temporary."""
+    T, H, W = stack.shape
+    nodata_is_nan = nodata!=nodata
+    for i in prange(H):
+        for j in range(W):
+            ok = True
+            for t in range(T):
+                v = stack[t,i,j]
+                if v==nodata or (nodata_is_nan and v!=v):
+                    ok = False
+                    break
+            out[i,j] = ok
+
+
+@njit(parallel=True, fastmath=True, cache=True)
+def _batched_lasso(X, Y, col_norms, threshold, max_iter, tol, out_beta):
+    """Coordinate-descent Lasso on centred X for every row of Y, one pixel per prange step."""
+    T, P = X.shape
+    for p in prange(Y.shape[0]):
+        beta = np.zeros_like(X[0])
+        r = Y[p].copy()
+        for _ in range(max_iter):
+            w_max = 0.0
+            d_max = 0.0
+            for j in range(P):
+                if col_norms[j]==0.0:
+                    continue
+                rho = col_norms[j] * beta[j]
+                for t in range(T):
+                    rho += X[t,j] * r[t]
+                new = np.sign(rho) * max(abs(rho) - threshold, 0.0) / col_norms[j]
+                delta = new - beta[j]
+                if delta!=0.0:
+                    for t in range(T):
+                        r[t] -= X[t,j] * delta
+                    beta[j] = new
+                d_max = max(d_max, abs(delta))
+                w_max = max(w_max, abs(new))
+            if w_max==0.0 or d_max/w_max < tol:
+                break
+        out_beta[p] = beta
+
+
+def _fit_lasso(X, Y, alpha=1.0, max_iter=1000, tol=1e-4):
+    """Lasso fit with intercept of every pixel series (rows of Y), using sklearn's objective and defaults."""
+    x_mean = X.mean(axis=0)
+    y_mean = Y.mean(axis=1)
+    Xc = np.ascontiguousarray(X - x_mean)
+    Yc = Y - y_mean[:,None]
+    beta = np.zeros((Y.shape[0], X.shape[1]), dtype=Y.dtype)
+    _batched_lasso(Xc, Yc, (Xc*Xc).sum(axis=0), alpha * X.shape[0], max_iter, tol, beta)
+    return beta, y_mean - beta @ x_mean
+
+
+def _score(Y, Y_hat):
+    """Per-pixel (row) R² and RMSE in float64; constant series follow sklearn's r2_score convention."""
+    xp = _array_module(Y)
+    Y = Y.astype(np.float64)
+    ss_res = ((Y - Y_hat)**2).sum(axis=1)
+    # Exact in float64 for float32 inputs, so constant series give ss_tot == 0
+    ss_tot = ((Y - Y.mean(axis=1, keepdims=True))**2).sum(axis=1)
+    # A float32 fit leaves residuals of a few ulps where sklearn's float64 fit leaves zero
+    tol = Y.shape[1] * (8 * np.finfo(np.float32).eps * xp.abs(Y).max(axis=1))**2
+    with np.errstate(divide='ignore', invalid='ignore'):
+        r2 = xp.where(ss_tot>0, 1 - ss_res/ss_tot, xp.where(ss_res<=tol, 1.0, 0.0))
+    return r2, xp.sqrt(ss_res / Y.shape[1])
+
 
 class NighttimeLightModeller(QgsProcessingAlgorithm):
     LAYER_LIST = 'LAYER_LIST'
@@ -110,104 +235,163 @@ class NighttimeLightModeller(QgsProcessingAlgorithm):
         model_name = ['Linear','Polynomial','Ridge','Lasso'][self.parameterAsEnum(parameters, self.MODEL_TYPE, context)]
         norm_name = ['None','MinMax','Z-score'][self.parameterAsEnum(parameters, self.NORMALIZATION, context)]
 
-        # Load rasters
-        with rasterio.Env():
-            with rasterio.open(paths[0]) as src:
-                profile = src.profile
-                nodata_val = src.nodata
-            arrays = [rasterio.open(p).read(1) for p in paths]
-        data = np.stack(arrays, axis=0)
-        years = np.arange(2013, 2013 + len(paths)).reshape(-1,1)
-        H, W = data.shape[1:]
-
-        # Mask NoData
-        valid_mask = ~np.any(data == nodata_val, axis=0) if nodata_val is not None else np.ones((H,W),bool)
-
-        flat = data.reshape(len(paths), -1)
-        n_pixels, n_future = H*W, future_years.shape[0]
-        preds = np.zeros((n_future, n_pixels),dtype=np.float32)
-        r2_vals = np.full(n_pixels,np.nan,dtype=np.float32)
-        rmse_vals = np.full(n_pixels,np.nan,dtype=np.float32)
-
-        # Prepare polynomial features if needed
+        n_years, n_future = len(paths), future_years.shape[0]
+
+        # Build the design matrix on year offsets from the mean input year (2013 onwards):
+        # small, well-conditioned values that float32 carries without loss. The fits
+        # estimate the intercept themselves, so no constant column is needed.
+        mean_year = 2013 + (n_years - 1) / 2
+        years_x = (np.arange(2013, 2013 + n_years) - mean_year).astype(np.float32).reshape(-1,1)
+        future_x = (future_years - mean_year).astype(np.float32)
         if model_name=='Polynomial':
-            poly = PolynomialFeatures(degree=2)
-            years_feat = poly.fit_transform(years)
-            future_feat = poly.transform(future_years)
+            years_feat = np.hstack([years_x, years_x*years_x])
+            future_feat = np.hstack([future_x, future_x*future_x])
         else:
-            years_feat, future_feat = years, future_years
+            years_feat, future_feat = years_x, future_x
+        fit = {'Linear':_fit_linear,
+               'Polynomial':_fit_linear,
+               'Ridge':_fit_ridge,
+               'Lasso':_fit_lasso}[model_name]
 
-        feedback.pushInfo(self.tr(f'Starting regression (model={model_name}, norm={norm_name})...'))
-        for idx in range(n_pixels):
-            if feedback.isCanceled(): break
-            if not valid_mask.flat[idx]: continue
-            y = flat[:,idx].reshape(-1,1)
-            # Normalize
-            if norm_name=='MinMax':
-                scaler = MinMaxScaler()
-                y_norm = scaler.fit_transform(y)
-            elif norm_name=='Z-score':
-                scaler = StandardScaler()
-                y_norm = scaler.fit_transform(y)
-            else:
-                scaler = None
-                y_norm = y
-            # Select model
-            mdl = {'Linear':LinearRegression(),
-                   'Polynomial':LinearRegression(),
-                   'Ridge':Ridge(),
-                   'Lasso':Lasso()}[model_name]
-            mdl.fit(years_feat,y_norm)
-            # Predictions
-            y_pred_norm = mdl.predict(years_feat).reshape(-1,1)
-            y_pred = scaler.inverse_transform(y_pred_norm) if scaler else y_pred_norm
-            pred_norm = mdl.predict(future_feat).reshape(-1,1)
-            pred = scaler.inverse_transform(pred_norm).flatten() if scaler else pred_norm.flatten()
-            preds[:,idx] = pred
-            # Metrics
-            r2_vals[idx] = mdl.score(years_feat,y_norm)
-            resid = y_pred.flatten() - y.flatten()
-            rmse_vals[idx] = np.sqrt(np.mean(resid**2))
-            if idx % max(1,n_pixels//100)==0:
-                feedback.setProgress(int(idx/n_pixels*100))
-
-        # Clip results
-        preds = np.maximum(preds,0).reshape((n_future,H,W))
+        # The dense solves run wherever their inputs live: with a CUDA device, each tile is copied
+        # over once and fitted, predicted and scored there. Lasso stays on the compiled CPU kernel
+        xp = np if model_name=='Lasso' else (_cupy() or np)
+        if xp is not np:
+            feedback.pushInfo(self.tr(f'CUDA device found; fitting {model_name} on the GPU.'))
+        X_fit, X_future = xp.asarray(years_feat), xp.asarray(future_feat)
 
         # Prepare output folder
         out_folder = self.parameterAsString(parameters,self.OUTPUT_FOLDER,context)
         os.makedirs(out_folder,exist_ok=True)
-        profile.update(count=1,dtype='float32')
+        out_paths = [os.path.join(out_folder,f'NTL_Pred_{yr}.tif') for yr in future_years.flatten()]
+
+        # An affine rescaling of y is absorbed by the intercept and slopes of least-squares
+        # and ridge fits, so normalization only changes the result for Lasso
+        if norm_name!='None' and model_name!='Lasso':
+            feedback.pushInfo(self.tr(f'{norm_name} normalization does not affect {model_name} forecasts; skipping it.'))
+            norm_name = 'None'
+        feedback.pushInfo(self.tr(f'Starting regression (model={model_name}, norm={norm_name})...'))
+        sample_keys = np.empty(0)
+        sample_actual = sample_pred = np.empty(0,dtype=np.float32)
+        # Running metric statistics, so no per-pixel R²/RMSE arrays are kept
+        n_valid, n_robust = 0, 0
+        r2_sum, r2_min, r2_max = 0.0, np.inf, -np.inf
+        rm_sum, rm_min, rm_max = 0.0, np.inf, -np.inf
+        rng = np.random.default_rng(0)
+        # One GDAL environment covers reading, regression and writing; a larger block
+        # cache lets the tiled writers buffer more blocks before flushing
+        gdal_env = dict(GDAL_CACHEMAX=1024, GDAL_NUM_THREADS='ALL_CPUS',
+                        VSI_CACHE=True, VSI_CACHE_SIZE=256*1024*1024)
+        with rasterio.Env(**gdal_env), ExitStack() as stack, \
+                ThreadPoolExecutor(max_workers=min(n_years, os.cpu_count() or 1)) as executor:
+            srcs = [stack.enter_context(rasterio.open(p,sharing=False)) for p in paths]
+            profile = srcs[0].profile
+            nodata_val = srcs[0].nodata
+            H, W = srcs[0].height, srcs[0].width
+            if any((src.height, src.width) != (H, W) for src in srcs):
+                raise QgsProcessingException(self.tr('All input rasters must have the same dimensions.'))
+            profile.update(driver='GTiff',count=1,dtype='float32',
+                           tiled=True,blockxsize=TILE_SIZE,blockysize=TILE_SIZE,
+                           compress='zstd',zstd_level=1,predictor=3,
+                           num_threads='all_cpus',BIGTIFF='IF_SAFER')
+            dsts = [stack.enter_context(rasterio.open(p,'w',sharing=False,**profile)) for p in out_paths]
+
+            def read_tile(win):
+                # Each band comes from its own dataset, so the reads can run concurrently
+                tile = np.empty((n_years, win.height, win.width), dtype=np.float32)
+                list(executor.map(lambda i: srcs[i].read(1, window=win, out=tile[i]), range(n_years)))
+                return tile
+
+            # Process tile by tile so memory stays bounded by the tile size, not the raster size
+            windows = [win for _, win in dsts[0].block_windows(1)]
+            for k, win in enumerate(windows):
+                if feedback.isCanceled(): break
+                tile = read_tile(win)
+
+                # Mask NoData
+                valid = np.ones(tile.shape[1:],bool)
+                if nodata_val is not None:
+                    # Compare in the tile's float32, as the raster values were cast on read
+                    _valid_mask(tile, tile.dtype.type(nodata_val), valid)
+                valid_idx = np.flatnonzero(valid)
+
+                # Shared design matrix: every valid pixel of the tile is fitted in a single batched solve
+                preds = np.zeros((n_future, valid.size),dtype=np.float32)
+                if valid_idx.size:
+                    # One contiguous row per pixel, so each time series is read sequentially
+                    Yv = np.ascontiguousarray(tile.reshape(n_years, -1).T[valid_idx])
+                    Yd = xp.asarray(Yv)
+                    y_norm, offset, scale = _normalize(Yd, norm_name)
+                    beta, intercept = fit(X_fit, y_norm)
+                    y_pred = beta @ X_fit.T + intercept[:,None]
+                    pred = beta @ X_future.T + intercept[:,None]
+                    if norm_name!='None':
+                        y_pred = y_pred * scale + offset
+                        pred = pred * scale + offset
+
+                    # Clip results in place
+                    xp.maximum(pred,0,out=pred)
+
+                    # Reduce the metrics where they were computed; only the statistics and the
+                    # clipped predictions come back to the host
+                    r2, rmse = _score(Yd, y_pred)
+                    stats = xp.stack([r2.sum(), r2.min(), r2.max(), rmse.sum(), rmse.min(), rmse.max(),
+                                      xp.count_nonzero(r2>=0.7)]).tolist()
+                    if xp is not np:
+                        pred = xp.asnumpy(pred)
+                    preds[:,valid_idx] = pred.T
+
+                    n_valid += valid_idx.size
+                    n_robust += int(stats[6])
+                    r2_sum += stats[0]
+                    r2_min, r2_max = min(r2_min, stats[1]), max(r2_max, stats[2])
+                    rm_sum += stats[3]
+                    rm_min, rm_max = min(rm_min, stats[4]), max(rm_max, stats[5])
+
+                    # Scatter sample: keep the valid pixels with the SCATTER_SAMPLES smallest random
+                    # keys seen so far. That is a uniform sample without replacement over the whole
+                    # raster, and every valid pixel when there are fewer than SCATTER_SAMPLES
+                    sample_keys = np.concatenate([sample_keys, rng.random(valid_idx.size)])
+                    sample_actual = np.concatenate([sample_actual, Yv[:,-1]])
+                    sample_pred = np.concatenate([sample_pred, pred[:,0]])
+                    if sample_keys.size > SCATTER_SAMPLES:
+                        keep = np.argpartition(sample_keys, SCATTER_SAMPLES)[:SCATTER_SAMPLES]
+                        sample_keys, sample_actual, sample_pred = sample_keys[keep], sample_actual[keep], sample_pred[keep]
+
+                # Stream predicted tiles to disk
+                preds = preds.reshape((n_future,win.height,win.width))
+                for dst, band in zip(dsts, preds):
+                    dst.write(band,1,window=win)
+                feedback.setProgress(int((k+1)/len(windows)*100))
+
+        if not n_valid:
+            # Do not leave all-zero predictions behind in the output folder
+            for out_path in out_paths:
+                if os.path.exists(out_path):
+                    os.remove(out_path)
+            raise QgsProcessingException(self.tr('Input rasters contain no valid pixels.'))
 
         # Log metrics
-        vr2 = r2_vals[~np.isnan(r2_vals)]
-        vrm = rmse_vals[~np.isnan(rmse_vals)]
-        feedback.pushInfo(f"R² - mean:{vr2.mean():.3f},min:{vr2.min():.3f},max:{vr2.max():.3f}")
-        feedback.pushInfo(f"RMSE - mean:{vrm.mean():.3f},min:{vrm.min():.3f},max:{vrm.max():.3f}")
-        robust_pct = 100 * np.sum(vr2>=0.7) / vr2.size
+        feedback.pushInfo(f"R² - mean:{r2_sum/n_valid:.3f},min:{r2_min:.3f},max:{r2_max:.3f}")
+        feedback.pushInfo(f"RMSE - mean:{rm_sum/n_valid:.3f},min:{rm_min:.3f},max:{rm_max:.3f}")
+        robust_pct = 100 * n_robust / n_valid
         feedback.pushInfo(f"Robust(R²>=0.7):{robust_pct:.1f}%")
 
         # Scatter plot actual vs predicted for first future year
-        actual = data[-1].flatten()[valid_mask.flatten()]
-        predicted = preds[0].flatten()[valid_mask.flatten()]
-        sample_size = min(10000,len(actual))
-        idxs = np.random.choice(len(actual),sample_size,replace=False)
-        plt.figure()
-        plt.scatter(actual[idxs],predicted[idxs],s=1)
-        plt.xlabel('Actual NTL')
-        plt.ylabel(f'Predicted NTL ({future_years.flatten()[0]})')
-        plt.title('Actual vs Predicted NTL')
+        # A bare Figure renders through Agg and never touches pyplot's GUI backend inside QGIS
+        fig = Figure()
+        ax = fig.subplots()
+        ax.scatter(sample_actual,sample_pred,s=1,rasterized=True)
+        ax.set_xlabel('Actual NTL')
+        ax.set_ylabel(f'Predicted NTL ({future_years.flatten()[0]})')
+        ax.set_title('Actual vs Predicted NTL')
         scatter_path = os.path.join(out_folder,'scatter_actual_vs_predicted.png')
-        plt.savefig(scatter_path)
-        plt.close()
+        fig.savefig(scatter_path,dpi=100)
         feedback.pushInfo(f"Scatter plot saved: {scatter_path}")
 
-        # Save predicted rasters
+        # Add predicted rasters to the project
         results = {}
-        for i,yr in enumerate(future_years.flatten()):
-            out_path = os.path.join(out_folder,f'NTL_Pred_{yr}.tif')
-            with rasterio.open(out_path,'w',**profile) as dst:
-                dst.write(preds[i],1)
+        for yr, out_path in zip(future_years.flatten(), out_paths):
             layer = QgsRasterLayer(out_path,f'NTL Prediction {yr}')
             if layer.isValid():
                 QgsProject.instance().addMapLayer(layer)